@@ -107,6 +107,8 @@ def parse_train_configs():
                         help='GPU index to use.')
     parser.add_argument('--no_cuda', action='store_true',
                         help='If true, cuda is not used.')
+    parser.add_argument('--cuda_rotated_iou', action='store_true',
+                        help='If true, build the CUDA kernel of the anchor matching IoU (experimental, needs nvcc).')
     parser.add_argument('--multiprocessing-distributed', action='store_true',
                         help='Use multi-processing distributed training to launch '
                              'N processes per node, which has N GPUs. This is the '
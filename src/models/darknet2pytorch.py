@@ -238,7 +238,11 @@ class Darknet(nn.Module):
                 continue
             else:
                 print('unknown type %s' % (block['type']))
-        yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
+        if any(yolo_output is None for yolo_output in yolo_outputs):
+            # The yolo layers skip the detection output in training, see YoloLayer.return_output_in_train
+            yolo_outputs = None
+        else:
+            yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
 
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
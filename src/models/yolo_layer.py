@@ -6,14 +6,65 @@
 """
 
 import sys
+from typing import Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from packaging import version
 
 sys.path.append('../')
 
-from utils.torch_utils import to_cpu
-from utils.evaluation_utils import rotated_box_wh_iou_polygon
+from utils.evaluation_utils import rotated_wh_iou
+
+try:
+    from utils.yolo_target_numba import build_targets_nb
+except ImportError:
+    # numba is optional, build_targets falls back to the PyTorch indexing on CPU
+    build_targets_nb = None
+
+METRIC_NAMES = ("loss", "x", "y", "w", "h", "im", "re", "conf", "cls")
+
+if version.parse(torch.__version__) >= version.parse('1.10.0'):
+    def _meshgrid_ij(*tensors):
+        return torch.meshgrid(*tensors, indexing='ij')
+else:
+    def _meshgrid_ij(*tensors):
+        return torch.meshgrid(*tensors)
+
+
+@torch.jit.script
+def sigmoid_scale(t: torch.Tensor, scale_x_y: float) -> torch.Tensor:
+    """ Center offset of the cells: sigmoid scaled by scale_x_y around 0.5, as one fused elementwise chain """
+    return torch.sigmoid(t) * scale_x_y - 0.5 * (scale_x_y - 1)
+
+
+@torch.jit.script
+def exp_scale(t: torch.Tensor, anchor: torch.Tensor) -> torch.Tensor:
+    """ Box size from the raw output: exp(t) * anchor, as one fused elementwise chain """
+    return torch.exp(t) * anchor
+
+
+@torch.jit.script
+def obj_losses(pred_obj: torch.Tensor, target_box: torch.Tensor, target_conf: torch.Tensor,
+               target_cls: torch.Tensor, scale_x_y: float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """ Losses of the positive cells, computed on the gathered raw predictions
+
+    :param pred_obj: [num_obj, 7 + num_classes] raw outputs of the positive cells
+    :param target_box: [num_obj, 6] (tx, ty, tw, th, tim, tre)
+    :param target_conf: [num_obj]
+    :param target_cls: [num_obj, num_classes] multi-hot class targets of the positive cells
+    :param scale_x_y:
+    :return: box losses [6] (x, y, w, h, im, re), conf loss, cls loss
+    """
+    xy = sigmoid_scale(pred_obj[:, :2], scale_x_y)
+    pred_box = torch.cat((xy, pred_obj[:, 2:6]), dim=1)
+    loss_box = ((pred_box - target_box) ** 2).mean(0)
+    # BCE on the logits: the sigmoid is fused in the loss
+    loss_conf_obj = F.binary_cross_entropy_with_logits(pred_obj[:, 6], target_conf)
+    loss_cls = F.binary_cross_entropy_with_logits(pred_obj[:, 7:], target_cls)
+
+    return loss_box, loss_conf_obj, loss_cls
 
 
 class YoloLayer(nn.Module):
@@ -35,48 +86,79 @@ class YoloLayer(nn.Module):
         self.class_scale = 1
 
         self.seen = 0
-        self.mse_loss = nn.MSELoss()
-        self.bce_loss = nn.BCELoss()
         # Initialize dummy variables
         self.grid_size = 0
         self.img_size = 0
-        self.metrics = {}
+        self._metrics = {}
+        # Loss values copied asynchronously to the host, only read when the metrics are accessed
+        self._metric_buf = None
+        self._metric_event = None
+        # Whether forward() also builds the detection output when targets are given (the loss alone is enough to train)
+        self.return_output_in_train = False
+        # Grid offsets and scaled anchors, keyed by (grid_size, device, img_size)
+        self._offset_cache = {}
+        # Target tensors of build_targets, keyed by (nB, nA, nG, device, dtype) and reset in place at each call
+        self._target_cache = {}
+
+    @property
+    def metrics(self):
+        if self._metric_buf is not None:
+            if self._metric_event is not None:
+                self._metric_event.synchronize()
+            self._metrics = dict(zip(METRIC_NAMES, self._metric_buf.tolist()))
+            self._metric_buf = None
+            self._metric_event = None
+        return self._metrics
 
     def compute_grid_offsets(self, grid_size):
         self.grid_size = grid_size
         g = self.grid_size
         self.stride = self.img_size / self.grid_size
-        # Calculate offsets for each grid
-        self.grid_x = torch.arange(g, device=self.device, dtype=torch.float).repeat(g, 1).view([1, 1, g, g])
-        self.grid_y = torch.arange(g, device=self.device, dtype=torch.float).repeat(g, 1).t().view([1, 1, g, g])
-        self.scaled_anchors = torch.tensor(
-            [(a_w / self.stride, a_h / self.stride, im, re) for a_w, a_h, im, re in self.anchors], device=self.device,
-            dtype=torch.float)
-        self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
-        self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
+        key = (g, self.device, self.img_size)
+        offsets = self._offset_cache.get(key)
+        if offsets is None:
+            # Calculate offsets for each grid
+            grid_range = torch.arange(g, device=self.device, dtype=torch.float)
+            grid_y, grid_x = _meshgrid_ij(grid_range, grid_range)
+            grid_x = grid_x.view([1, 1, g, g])
+            grid_y = grid_y.view([1, 1, g, g])
+            scaled_anchors = torch.as_tensor(self.anchors, device=self.device, dtype=torch.float).clone()
+            scaled_anchors[:, :2] /= self.stride
+            anchor_w = scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
+            anchor_h = scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
+            offsets = (grid_x, grid_y, scaled_anchors, anchor_w, anchor_h)
+            self._offset_cache[key] = offsets
+        self.grid_x, self.grid_y, self.scaled_anchors, self.anchor_w, self.anchor_h = offsets
 
     def build_targets(self, pred_cls, target, anchors):
         """ Built yolo targets to compute loss
 
-        :param pred_cls: [num_samples or batch, num_anchors, grid_size, grid_size, num_classes]
+        :param pred_cls: [num_samples or batch, num_anchors, num_classes, grid_size, grid_size]
         :param target: [num_boxes, 8]
         :param anchors: [num_anchors, 4]
-        :return:
+        :return: obj_mask, noobj_mask, tbox [nB, nA, nG, nG, 6] (tx, ty, tw, th, tim, tre),
+                 tcls [num_obj, num_classes] in the order of obj_mask.nonzero(), tconf
         """
-        nB, nA, nG, _, nC = pred_cls.size()
+        nB, nA, nC, nG, _ = pred_cls.size()
         n_target_boxes = target.size(0)
 
-        # Create output tensors on "device"
-        obj_mask = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.uint8)
-        noobj_mask = torch.full(size=(nB, nA, nG, nG), fill_value=1, device=self.device, dtype=torch.uint8)
-        tx = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        ty = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tw = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        th = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tim = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tre = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tcls = torch.full(size=(nB, nA, nG, nG, nC), fill_value=0, device=self.device, dtype=torch.float)
-        tconf = obj_mask.float()
+        # Create output tensors on "device" once per shape, then reuse them
+        # The targets follow the dtype of the predictions so that mixed precision training is not upcast
+        dtype = pred_cls.dtype
+        key = (nB, nA, nG, self.device, dtype)
+        buffers = self._target_cache.get(key)
+        if buffers is None:
+            obj_mask = torch.empty((nB, nA, nG, nG), device=self.device, dtype=torch.bool)
+            noobj_mask = torch.empty((nB, nA, nG, nG), device=self.device, dtype=torch.bool)
+            tbox = torch.empty((nB, nA, nG, nG, 6), device=self.device, dtype=dtype)
+            tconf = torch.empty((nB, nA, nG, nG), device=self.device, dtype=dtype)
+            buffers = (obj_mask, noobj_mask, tbox, tconf)
+            self._target_cache[key] = buffers
+        obj_mask, noobj_mask, tbox, tconf = buffers
+        obj_mask.fill_(False)
+        noobj_mask.fill_(True)
+        tbox.zero_()
+        tcls = torch.zeros((0, nC), device=self.device, dtype=dtype)
 
         if n_target_boxes > 0:  # Make sure that there is at least 1 box
             # Convert to position relative to box
@@ -87,7 +169,7 @@ class YoloLayer(nn.Module):
             gimre = target_boxes[:, 4:]
 
             # Get anchors with best iou
-            ious = torch.stack([rotated_box_wh_iou_polygon(anchor, gwh, gimre) for anchor in anchors])
+            ious = rotated_wh_iou(anchors, gwh, gimre)  # [nA, nT]
             best_ious, best_n = ious.max(0)
 
             b, target_labels = target[:, :2].long().t()
@@ -96,29 +178,44 @@ class YoloLayer(nn.Module):
             gw, gh = gwh.t()
             gim, gre = gimre.t()
             gi, gj = gxy.long().t()
+
+            # One-hot encoding of label, only for the positive cells: the targets sharing a cell are rows of the
+            # same sorted cell index, i.e. the order of obj_mask.nonzero(), and their classes are all set
+            cells = ((b % nB * nA + best_n) * nG + gj % nG) * nG + gi % nG
+            obj_cells, obj_rows = torch.unique(cells, sorted=True, return_inverse=True)
+            tcls = torch.zeros((obj_cells.size(0), nC), device=self.device, dtype=dtype)
+            tcls[obj_rows, target_labels] = 1
+
+            use_numba = (build_targets_nb is not None) and (self.device.type == 'cpu')
+            if use_numba and (dtype in (torch.float, torch.double)):
+                # Single compiled loop over the targets, writing into the numpy views of the buffers
+                build_targets_nb(b.numpy(), best_n.numpy(), gi.numpy(), gj.numpy(), gx.numpy(), gy.numpy(),
+                                 gw.numpy(), gh.numpy(), gim.numpy(), gre.numpy(), anchors.numpy(),
+                                 ious.numpy(), self.ignore_thresh, obj_mask.numpy(), noobj_mask.numpy(), tbox.numpy())
+                tconf.copy_(obj_mask)
+                return obj_mask, noobj_mask, tbox, tcls, tconf
+
             # Set masks
-            obj_mask[b, best_n, gj, gi] = 1
-            noobj_mask[b, best_n, gj, gi] = 0
+            obj_mask[b, best_n, gj, gi] = True
+            noobj_mask[b, best_n, gj, gi] = False
 
             # Set noobj mask to zero where iou exceeds ignore threshold
-            for i, anchor_ious in enumerate(ious.t()):
-                noobj_mask[b[i], anchor_ious > self.ignore_thresh, gj[i], gi[i]] = 0
+            ignore_t, ignore_a = (ious.t() > self.ignore_thresh).nonzero(as_tuple=True)  # (target, anchor) pairs
+            noobj_mask[b[ignore_t], ignore_a, gj[ignore_t], gi[ignore_t]] = False
 
-            # Coordinates
-            tx[b, best_n, gj, gi] = gx - gx.floor()
-            ty[b, best_n, gj, gi] = gy - gy.floor()
-            # Width and height
-            tw[b, best_n, gj, gi] = torch.log(gw / anchors[best_n][:, 0] + 1e-16)
-            th[b, best_n, gj, gi] = torch.log(gh / anchors[best_n][:, 1] + 1e-16)
-            # Im and real part
-            tim[b, best_n, gj, gi] = gim
-            tre[b, best_n, gj, gi] = gre
+            # Coordinates, width and height, im and real part: one write of the 6 channels
+            tbox.index_put_((b, best_n, gj, gi), torch.stack([
+                gx - gx.floor(),
+                gy - gy.floor(),
+                torch.log(gw / anchors[best_n][:, 0] + 1e-16),
+                torch.log(gh / anchors[best_n][:, 1] + 1e-16),
+                gim,
+                gre,
+            ], dim=-1).to(dtype), accumulate=False)
 
-            # One-hot encoding of label
-            tcls[b, best_n, gj, gi, target_labels] = 1
-            tconf = obj_mask.float()
+        tconf.copy_(obj_mask)
 
-        return obj_mask.type(torch.bool), noobj_mask.type(torch.bool), tx, ty, tw, th, tim, tre, tcls, tconf
+        return obj_mask, noobj_mask, tbox, tcls, tconf
 
     def forward(self, x, targets=None, img_size=608):
         """
@@ -131,74 +228,84 @@ class YoloLayer(nn.Module):
         self.device = x.device
         num_samples, _, _, grid_size = x.size()
 
-        prediction = x.view(num_samples, self.num_anchors, self.num_classes + 7, grid_size, grid_size)
-        prediction = prediction.permute(0, 1, 3, 4, 2).contiguous()
-        # prediction size: [num_samples, num_anchors, grid_size, grid_size, num_classes + 7]
-
-        # Get outputs
-        x = torch.sigmoid(prediction[..., 0]) * self.scale_x_y - 0.5 * (self.scale_x_y - 1)  # Center x
-        y = torch.sigmoid(prediction[..., 1]) * self.scale_x_y - 0.5 * (self.scale_x_y - 1)  # Center y
-        w = prediction[..., 2]  # Width
-        h = prediction[..., 3]  # Height
-        im = prediction[..., 4]  # angle imaginary part
-        re = prediction[..., 5]  # angle real part
-        pred_conf = torch.sigmoid(prediction[..., 6])  # Conf
-        pred_cls = torch.sigmoid(prediction[..., 7:])  # Cls pred.
-
-        # If grid size does not match current we compute new offsets
-        if grid_size != self.grid_size:
-            self.compute_grid_offsets(grid_size)
-
-        # Add offset and scale with anchors
-        # pred_boxes size: [num_samples, num_anchors, grid_size, grid_size, 6]
-        pred_boxes = torch.empty(prediction[..., :6].shape, device=self.device, dtype=torch.float)
-        pred_boxes[..., 0] = x.detach() + self.grid_x
-        pred_boxes[..., 1] = y.detach() + self.grid_y
-        pred_boxes[..., 2] = torch.exp(w.detach()) * self.anchor_w
-        pred_boxes[..., 3] = torch.exp(h.detach()) * self.anchor_h
-        pred_boxes[..., 4] = im.detach()
-        pred_boxes[..., 5] = re.detach()
-
-        output = torch.cat((
-            pred_boxes[..., :4].view(num_samples, -1, 4) * self.stride,
-            pred_boxes[..., 4:].view(num_samples, -1, 2),
-            pred_conf.view(num_samples, -1, 1),
-            pred_cls.view(num_samples, -1, self.num_classes),
-        ), dim=-1)
-        # output size: [num_samples, num boxes, 7 + num_classes]
+        # Keep the channels on dim 2 and slice them as views (no permute + contiguous copy)
+        if x.is_contiguous():
+            prediction = x.view(num_samples, self.num_anchors, self.num_classes + 7, grid_size, grid_size)
+        else:
+            # channels_last input (NHWC in memory): the same view, built from the NHWC order without a copy
+            prediction = x.permute(0, 2, 3, 1).reshape(num_samples, grid_size, grid_size, self.num_anchors,
+                                                       self.num_classes + 7).permute(0, 3, 4, 1, 2)
+        # prediction size: [num_samples, num_anchors, num_classes + 7, grid_size, grid_size]
+
+        # Look up (or compute once) the offsets for the current grid size, device and image size
+        self.compute_grid_offsets(grid_size)
+
+        output = None
+        # The training loop only needs the loss, so the detection output is skipped unless it is asked for
+        if (targets is None) or self.return_output_in_train:
+            # One sigmoid over the adjacent conf and cls channels
+            pred_conf_cls = torch.sigmoid(prediction[:, :, 6:])
+            pred_conf = pred_conf_cls[:, :, 0]  # Conf
+            pred_cls = pred_conf_cls[:, :, 1:]  # Cls pred. [num_samples, num_anchors, num_classes, G, G]
+
+            # Fill the output buffer in place, pred_boxes is a view of its first 6 channels
+            output = torch.empty((num_samples, self.num_anchors * grid_size * grid_size, self.num_classes + 7),
+                                 device=self.device, dtype=prediction.dtype)
+            output_cells = output.view(num_samples, self.num_anchors, grid_size, grid_size, self.num_classes + 7)
+
+            # The boxes never carry gradients: build them without autograd, directly in the output buffer
+            with torch.no_grad():
+                # Get outputs
+                x, y = sigmoid_scale(prediction[:, :, :2], self.scale_x_y).unbind(2)  # Center x, y
+                w = prediction[:, :, 2]  # Width
+                h = prediction[:, :, 3]  # Height
+                imre = prediction[:, :, 4:6]  # angle imaginary and real parts
+
+                # Add offset and scale with anchors
+                # pred_boxes size: [num_samples, num_anchors, grid_size, grid_size, 6]
+                pred_boxes = output_cells[..., :6]
+                torch.add(x, self.grid_x, out=pred_boxes[..., 0])
+                torch.add(y, self.grid_y, out=pred_boxes[..., 1])
+                pred_boxes[..., 2] = exp_scale(w, self.anchor_w)
+                pred_boxes[..., 3] = exp_scale(h, self.anchor_h)
+                pred_boxes[..., 4:] = imre.permute(0, 1, 3, 4, 2)
+                pred_boxes[..., :4] *= self.stride
+
+            output_cells[..., 6] = pred_conf
+            output_cells[..., 7:] = pred_cls.permute(0, 1, 3, 4, 2)
+            # output size: [num_samples, num boxes, 7 + num_classes]
 
         if targets is None:
             return output, 0
         else:
-            obj_mask, noobj_mask, tx, ty, tw, th, tim, tre, tcls, tconf = self.build_targets(pred_cls=pred_cls,
-                                                                                             target=targets,
-                                                                                             anchors=self.scaled_anchors)
+            obj_mask, noobj_mask, tbox, tcls, tconf = self.build_targets(
+                pred_cls=prediction[:, :, 7:], target=targets, anchors=self.scaled_anchors)
 
             # Loss : Mask outputs to ignore non-existing objects (except with conf. loss)
-            loss_x = self.mse_loss(x[obj_mask], tx[obj_mask])
-            loss_y = self.mse_loss(y[obj_mask], ty[obj_mask])
-            loss_w = self.mse_loss(w[obj_mask], tw[obj_mask])
-            loss_h = self.mse_loss(h[obj_mask], th[obj_mask])
-            loss_im = self.mse_loss(im[obj_mask], tim[obj_mask])
-            loss_re = self.mse_loss(re[obj_mask], tre[obj_mask])
+            # Gather the positive cells once and compute all of their losses on the packed tensors
+            obj_b, obj_a, obj_j, obj_i = obj_idx = obj_mask.nonzero(as_tuple=True)
+            pred_obj = prediction[obj_b, obj_a, :, obj_j, obj_i]  # [num_obj, num_classes + 7]
+            loss_box, loss_conf_obj, loss_cls = obj_losses(pred_obj, tbox[obj_idx], tconf[obj_idx],
+                                                           tcls, self.scale_x_y)
+            loss_x, loss_y, loss_w, loss_h, loss_im, loss_re = loss_box.unbind(0)
             loss_eular = loss_im + loss_re
-            loss_conf_obj = self.bce_loss(pred_conf[obj_mask], tconf[obj_mask])
-            loss_conf_noobj = self.bce_loss(pred_conf[noobj_mask], tconf[noobj_mask])
+            # Autograd keeps the mask of the indexing: give it a copy, the cached one is reset by the next call
+            noobj_mask = noobj_mask.clone()
+            loss_conf_noobj = F.binary_cross_entropy_with_logits(prediction[:, :, 6][noobj_mask], tconf[noobj_mask])
             loss_conf = self.obj_scale * loss_conf_obj + self.noobj_scale * loss_conf_noobj
-            loss_cls = self.bce_loss(pred_cls[obj_mask], tcls[obj_mask])
             total_loss = loss_x + loss_y + loss_w + loss_h + loss_eular + loss_conf + loss_cls
 
             # Metrics (store loss values using tensorboard)
-            self.metrics = {
-                "loss": to_cpu(total_loss).item(),
-                "x": to_cpu(loss_x).item(),
-                "y": to_cpu(loss_y).item(),
-                "w": to_cpu(loss_w).item(),
-                "h": to_cpu(loss_h).item(),
-                "im": to_cpu(loss_im).item(),
-                "re": to_cpu(loss_re).item(),
-                "conf": to_cpu(loss_conf).item(),
-                "cls": to_cpu(loss_cls).item()
-            }
+            # One async device-to-host copy, the values are only synchronized when self.metrics is read
+            scalars = torch.stack(
+                [total_loss, loss_x, loss_y, loss_w, loss_h, loss_im, loss_re, loss_conf, loss_cls]).detach()
+            if scalars.is_cuda:
+                self._metric_buf = torch.empty(scalars.shape, dtype=scalars.dtype, pin_memory=True)
+                self._metric_buf.copy_(scalars, non_blocking=True)
+                self._metric_event = torch.cuda.Event()
+                self._metric_event.record()
+            else:
+                self._metric_buf = scalars
+                self._metric_event = None
 
             return output, total_loss
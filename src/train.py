@@ -20,6 +20,7 @@ from data_process.kitti_dataloader import create_train_dataloader, create_val_da
 from models.model_utils import create_model, make_data_parallel, get_num_parameters
 from utils.train_utils import create_optimizer, create_lr_scheduler, get_saved_state, save_checkpoint
 from utils.train_utils import reduce_tensor, to_python_float, get_tensorboard_log
+from utils.evaluation_utils import load_rotated_wh_iou_cuda
 from utils.misc import AverageMeter, ProgressMeter
 from utils.logger import Logger
 from config.train_config import parse_train_configs
@@ -81,6 +82,9 @@ def main_worker(gpu_idx, configs):
 
     # model
     model = create_model(configs)
+    # The CUDA kernel of the anchor matching is opt-in, compiled here rather than in the first training step
+    if configs.cuda_rotated_iou and (not configs.no_cuda):
+        load_rotated_wh_iou_cuda()
 
     # load weight from a checkpoint
     if configs.pretrained_path is not None:
@@ -0,0 +1,159 @@
+/*
+ * IoU of rotated boxes sharing the same center, for anchor matching in YoloLayer.build_targets
+ * One thread per (anchor, target) pair, the geometry is computed in double precision.
+ * Python fallback / reference: utils.evaluation_utils.rotated_wh_iou_sat
+ */
+
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAGuard.h>
+
+namespace {
+
+constexpr double kEps = 1e-6;
+constexpr int kMaxPoints = 24;  // 4 + 4 corners and 4 x 4 edge crossings
+
+// 4 corners of a box centered at the origin, same ordering as bev_utils.get_corners
+__device__ inline void centered_corners(double w, double l, double sin_yaw, double cos_yaw, double* xs, double* ys) {
+    const double sign_w[4] = {-1., -1., 1., 1.};
+    const double sign_l[4] = {1., -1., -1., 1.};
+    for (int k = 0; k < 4; ++k) {
+        xs[k] = sign_w[k] * w / 2 * cos_yaw - sign_l[k] * l / 2 * sin_yaw;
+        ys[k] = sign_w[k] * w / 2 * sin_yaw + sign_l[k] * l / 2 * cos_yaw;
+    }
+}
+
+__device__ inline bool inside(double x, double y, double w, double l, double sin_yaw, double cos_yaw) {
+    // Project the point on the box axes
+    const double u = x * cos_yaw + y * sin_yaw;
+    const double v = -x * sin_yaw + y * cos_yaw;
+    const double tol = kEps * (1. + fmax(fabs(w), fabs(l)));
+    return fabs(u) <= w / 2 + tol && fabs(v) <= l / 2 + tol;
+}
+
+__global__ void rotated_wh_iou_kernel(const float* __restrict__ anchors, const float* __restrict__ targets,
+                                      float* __restrict__ ious, const int num_anchors, const int num_targets) {
+    const int num_pairs = num_anchors * num_targets;
+    for (int idx = blockIdx.x * blockDim.x + threadIdx.x; idx < num_pairs; idx += blockDim.x * gridDim.x) {
+        const int i = idx / num_targets;
+        const int j = idx % num_targets;
+
+        // SoA inputs: [4, num], rows are (w, l, im, re)
+        const double w_a = __ldg(anchors + i);
+        const double l_a = __ldg(anchors + num_anchors + i);
+        double sin_a = __ldg(anchors + 2 * num_anchors + i);
+        double cos_a = __ldg(anchors + 3 * num_anchors + i);
+        const double w_t = __ldg(targets + j);
+        const double l_t = __ldg(targets + num_targets + j);
+        double sin_t = __ldg(targets + 2 * num_targets + j);
+        double cos_t = __ldg(targets + 3 * num_targets + j);
+
+        const double norm_a = fmax(sqrt(sin_a * sin_a + cos_a * cos_a), kEps);
+        const double norm_t = fmax(sqrt(sin_t * sin_t + cos_t * cos_t), kEps);
+        sin_a /= norm_a;
+        cos_a /= norm_a;
+        sin_t /= norm_t;
+        cos_t /= norm_t;
+
+        double ax[4], ay[4], tx[4], ty[4];
+        centered_corners(w_a, l_a, sin_a, cos_a, ax, ay);
+        centered_corners(w_t, l_t, sin_t, cos_t, tx, ty);
+
+        // Vertices of the intersection polygon
+        double pts_x[kMaxPoints], pts_y[kMaxPoints];
+        int num_points = 0;
+        for (int k = 0; k < 4; ++k) {
+            if (inside(ax[k], ay[k], w_t, l_t, sin_t, cos_t)) {
+                pts_x[num_points] = ax[k];
+                pts_y[num_points++] = ay[k];
+            }
+            if (inside(tx[k], ty[k], w_a, l_a, sin_a, cos_a)) {
+                pts_x[num_points] = tx[k];
+                pts_y[num_points++] = ty[k];
+            }
+        }
+        for (int e = 0; e < 4; ++e) {
+            const double a_dx = ax[(e + 1) % 4] - ax[e];
+            const double a_dy = ay[(e + 1) % 4] - ay[e];
+            for (int f = 0; f < 4; ++f) {
+                const double t_dx = tx[(f + 1) % 4] - tx[f];
+                const double t_dy = ty[(f + 1) % 4] - ty[f];
+                const double denom = a_dx * t_dy - a_dy * t_dx;
+                if (fabs(denom) <= kEps) {
+                    continue;  // parallel edges
+                }
+                const double diff_x = tx[f] - ax[e];
+                const double diff_y = ty[f] - ay[e];
+                const double s = (diff_x * t_dy - diff_y * t_dx) / denom;
+                const double r = (diff_x * a_dy - diff_y * a_dx) / denom;
+                if (s >= -kEps && s <= 1 + kEps && r >= -kEps && r <= 1 + kEps) {
+                    pts_x[num_points] = ax[e] + s * a_dx;
+                    pts_y[num_points++] = ay[e] + s * a_dy;
+                }
+            }
+        }
+
+        double inter_area = 0.;
+        if (num_points >= 3) {
+            // The polygon is convex and contains the common center: sort the vertices by angle
+            double angles[kMaxPoints];
+            for (int k = 0; k < num_points; ++k) {
+                angles[k] = atan2(pts_y[k], pts_x[k]);
+            }
+            for (int k = 1; k < num_points; ++k) {
+                const double angle = angles[k], x = pts_x[k], y = pts_y[k];
+                int m = k - 1;
+                while (m >= 0 && angles[m] > angle) {
+                    angles[m + 1] = angles[m];
+                    pts_x[m + 1] = pts_x[m];
+                    pts_y[m + 1] = pts_y[m];
+                    --m;
+                }
+                angles[m + 1] = angle;
+                pts_x[m + 1] = x;
+                pts_y[m + 1] = y;
+            }
+            // Shoelace formula
+            for (int k = 0; k < num_points; ++k) {
+                const int next = (k + 1) % num_points;
+                inter_area += pts_x[k] * pts_y[next] - pts_y[k] * pts_x[next];
+            }
+            inter_area = fabs(inter_area) / 2;
+        }
+
+        const double union_area = w_a * l_a + w_t * l_t - inter_area;
+        ious[idx] = static_cast<float>(inter_area / (union_area + 1e-12));
+    }
+}
+
+}  // namespace
+
+torch::Tensor rotated_wh_iou(torch::Tensor anchors, torch::Tensor targets) {
+    TORCH_CHECK(anchors.is_cuda() && targets.is_cuda(), "rotated_wh_iou: inputs must be CUDA tensors");
+    TORCH_CHECK(anchors.dim() == 2 && anchors.size(0) == 4, "rotated_wh_iou: anchors must be [4, num_anchors]");
+    TORCH_CHECK(targets.dim() == 2 && targets.size(0) == 4, "rotated_wh_iou: targets must be [4, num_targets]");
+
+    const at::cuda::OptionalCUDAGuard device_guard(anchors.device());
+    const auto anchors_f = anchors.to(torch::kFloat).contiguous();
+    const auto targets_f = targets.to(torch::kFloat).contiguous();
+    const int num_anchors = anchors_f.size(1);
+    const int num_targets = targets_f.size(1);
+
+    auto ious = torch::zeros({num_anchors, num_targets}, anchors_f.options());
+    const int num_pairs = num_anchors * num_targets;
+    if (num_pairs == 0) {
+        return ious;
+    }
+
+    const int threads = 256;
+    const int blocks = std::min((num_pairs + threads - 1) / threads, 4096);
+    rotated_wh_iou_kernel<<<blocks, threads, 0, at::cuda::getCurrentCUDAStream()>>>(
+        anchors_f.data_ptr<float>(), targets_f.data_ptr<float>(), ious.data_ptr<float>(), num_anchors, num_targets);
+    AT_CUDA_CHECK(cudaGetLastError());
+
+    return ious;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("rotated_wh_iou", &rotated_wh_iou, "IoU of co-centered rotated boxes [num_anchors, num_targets] (CUDA)");
+}
@@ -1,7 +1,9 @@
 from __future__ import division
+import os
 import sys
 import tqdm
 import time
+import warnings
 
 import torch
 import numpy as np
@@ -218,25 +220,136 @@ def get_batch_statistics_rotated_bbox(outputs, targets, iou_threshold):
     return batch_metrics
 
 
-def rotated_box_wh_iou_polygon(anchor, wh, imre):
-    device = wh.device
-    w1, h1, im1, re1 = anchor[0], anchor[1], anchor[2], anchor[3]
+def get_centered_corners(wh, sin_yaw, cos_yaw):
+    """ 4 corners of boxes centered at the origin, same ordering as bev_utils.get_corners
 
-    wh = wh.t()
-    imre = imre.t()
-    w2, h2, im2, re2 = wh[0], wh[1], imre[0], imre[1]
-
-    anchor_box = torch.tensor([100, 100, w1, h1, im1, re1], device=device, dtype=torch.float).view(-1, 6)
-    target_boxes = torch.full(size=(w2.shape[0], 6), fill_value=100, device=device, dtype=torch.float)
-
-    target_boxes[:, 2] = w2
-    target_boxes[:, 3] = h2
-    target_boxes[:, 4] = im2
-    target_boxes[:, 5] = re2
-
-    ious = rotated_bbox_iou_polygon_vectorize(anchor_box[0], target_boxes)
+    :param wh: [..., 2]
+    :param sin_yaw: [...]
+    :param cos_yaw: [...]
+    :return: x, y of the corners, each [..., 4]
+    """
+    half_w = wh[..., 0:1] / 2
+    half_l = wh[..., 1:2] / 2
+    sign_w = wh.new_tensor([-1., -1., 1., 1.])
+    sign_l = wh.new_tensor([1., -1., -1., 1.])
+    sin_yaw, cos_yaw = sin_yaw.unsqueeze(-1), cos_yaw.unsqueeze(-1)
+    corners_x = sign_w * half_w * cos_yaw - sign_l * half_l * sin_yaw
+    corners_y = sign_w * half_w * sin_yaw + sign_l * half_l * cos_yaw
+
+    return corners_x, corners_y
+
+
+def rotated_wh_iou_sat(anchors, wh, imre, eps=1e-6):
+    """ calculate IoU of every anchor with every target box when both are centered at the same point.
+    The boxes always overlap (SAT can never separate them), so the intersection polygon is built
+    analytically from the corners inside the other box and the edge-edge crossings, then its area is
+    computed with the shoelace formula. No trigonometric function is evaluated: (im, re) are used as (sin, cos).
+
+    :param anchors: [num_anchors, 4] (w, l, im, re)
+    :param wh: [num_targets, 2]
+    :param imre: [num_targets, 2]
+    :return: [num_anchors, num_targets]
+    """
+    nA, nT = anchors.size(0), wh.size(0)
+    anchor_norm = torch.sqrt(anchors[:, 2] ** 2 + anchors[:, 3] ** 2).clamp(min=eps)
+    target_norm = torch.sqrt(imre[:, 0] ** 2 + imre[:, 1] ** 2).clamp(min=eps)
+    sin_a, cos_a = (anchors[:, 2] / anchor_norm)[:, None], (anchors[:, 3] / anchor_norm)[:, None]
+    sin_t, cos_t = (imre[:, 0] / target_norm)[None, :], (imre[:, 1] / target_norm)[None, :]
+    wh_a = anchors[:, None, :2].expand(nA, nT, 2)
+    wh_t = wh[None, :, :].expand(nA, nT, 2)
+    sin_a, cos_a = sin_a.expand(nA, nT), cos_a.expand(nA, nT)
+    sin_t, cos_t = sin_t.expand(nA, nT), cos_t.expand(nA, nT)
+
+    # Corners (SoA layout): [nA, nT, 4]
+    ax, ay = get_centered_corners(wh_a, sin_a, cos_a)
+    tx, ty = get_centered_corners(wh_t, sin_t, cos_t)
+
+    def inside(px, py, box_wh, sin_yaw, cos_yaw):
+        # Project the points on the box axes
+        u = px * cos_yaw.unsqueeze(-1) + py * sin_yaw.unsqueeze(-1)
+        v = -px * sin_yaw.unsqueeze(-1) + py * cos_yaw.unsqueeze(-1)
+        tol = eps * (1. + box_wh.abs().max(-1, keepdim=True)[0])
+        return (u.abs() <= box_wh[..., 0:1] / 2 + tol) & (v.abs() <= box_wh[..., 1:2] / 2 + tol)
+
+    a_in_t = inside(ax, ay, wh_t, sin_t, cos_t)
+    t_in_a = inside(tx, ty, wh_a, sin_a, cos_a)
+
+    # Edge-edge crossings: [nA, nT, 4 (anchor edges), 4 (target edges)]
+    a_x1, a_y1 = ax.unsqueeze(-1), ay.unsqueeze(-1)
+    a_dx, a_dy = (ax.roll(-1, -1) - ax).unsqueeze(-1), (ay.roll(-1, -1) - ay).unsqueeze(-1)
+    t_x1, t_y1 = tx.unsqueeze(-2), ty.unsqueeze(-2)
+    t_dx, t_dy = (tx.roll(-1, -1) - tx).unsqueeze(-2), (ty.roll(-1, -1) - ty).unsqueeze(-2)
+    denom = a_dx * t_dy - a_dy * t_dx
+    not_parallel = denom.abs() > eps
+    denom = torch.where(not_parallel, denom, torch.ones_like(denom))
+    diff_x, diff_y = t_x1 - a_x1, t_y1 - a_y1
+    s = (diff_x * t_dy - diff_y * t_dx) / denom
+    r = (diff_x * a_dy - diff_y * a_dx) / denom
+    cross_valid = not_parallel & (s >= -eps) & (s <= 1 + eps) & (r >= -eps) & (r <= 1 + eps)
+    cross_x = (a_x1 + s * a_dx).flatten(-2)
+    cross_y = (a_y1 + s * a_dy).flatten(-2)
+
+    # Candidate vertices of the intersection polygon: [nA, nT, 24]
+    pts_x = torch.cat((ax, tx, cross_x), dim=-1)
+    pts_y = torch.cat((ay, ty, cross_y), dim=-1)
+    valid = torch.cat((a_in_t, t_in_a, cross_valid.flatten(-2)), dim=-1)
+
+    # The polygon is convex and contains the common center: sort the valid vertices by angle,
+    # and collapse the invalid ones onto the first vertex so that they add no area
+    angles = torch.atan2(pts_y, pts_x)
+    angles = torch.where(valid, angles, torch.full_like(angles, 4.))
+    order = angles.argsort(dim=-1)
+    pts_x, pts_y, valid = pts_x.gather(-1, order), pts_y.gather(-1, order), valid.gather(-1, order)
+    pts_x = torch.where(valid, pts_x, pts_x[..., 0:1])
+    pts_y = torch.where(valid, pts_y, pts_y[..., 0:1])
+    inter_area = 0.5 * (pts_x * pts_y.roll(-1, -1) - pts_y * pts_x.roll(-1, -1)).sum(-1).abs()
+
+    area_a = wh_a[..., 0] * wh_a[..., 1]
+    area_t = wh_t[..., 0] * wh_t[..., 1]
+
+    return inter_area / (area_a + area_t - inter_area + 1e-12)
+
+
+# CUDA extension of rotated_wh_iou_sat, opt-in through load_rotated_wh_iou_cuda() (None: not loaded, False: unavailable)
+_rotated_wh_iou_cuda = None
+
+
+def load_rotated_wh_iou_cuda():
+    """ Compile (or load from the torch extensions cache) the CUDA kernel of rotated_wh_iou.
+    Call it once when the model is built: rotated_wh_iou never compiles the kernel itself
+
+    :return: the extension module, or False if it can not be built
+    """
+    global _rotated_wh_iou_cuda
+    if _rotated_wh_iou_cuda is None:
+        try:
+            from torch.utils.cpp_extension import load
+            source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cuda', 'rotated_wh_iou_cuda.cu')
+            _rotated_wh_iou_cuda = load(name='rotated_wh_iou_cuda', sources=[source], verbose=False)
+        except Exception as e:
+            warnings.warn('rotated_wh_iou CUDA extension is not available ({}), fall back to PyTorch'.format(e),
+                          RuntimeWarning)
+            _rotated_wh_iou_cuda = False
+
+    return _rotated_wh_iou_cuda
+
+
+def rotated_wh_iou(anchors, wh, imre):
+    """ calculate IoU of every anchor with every target box when both are centered at the same point.
+    Use the CUDA kernel for CUDA tensors if load_rotated_wh_iou_cuda() has loaded it, else rotated_wh_iou_sat
+
+    :param anchors: [num_anchors, 4] (w, l, im, re)
+    :param wh: [num_targets, 2]
+    :param imre: [num_targets, 2]
+    :return: [num_anchors, num_targets]
+    """
+    if wh.is_cuda and _rotated_wh_iou_cuda:
+        # SoA layout: [4, num] (w, l, im, re)
+        targets = torch.cat((wh, imre), dim=1)
+        ious = _rotated_wh_iou_cuda.rotated_wh_iou(anchors.t().contiguous(), targets.t().contiguous())
+        return ious.to(wh.dtype)
 
-    return torch.from_numpy(ious)
+    return rotated_wh_iou_sat(anchors, wh, imre)
 
 
 def rotated_box_11_iou_polygon(box1, box2, nG, device):
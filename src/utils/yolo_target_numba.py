@@ -0,0 +1,54 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Numba kernel of YoloLayer.build_targets for CPU tensors
+"""
+
+import math
+
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def build_targets_nb(b, best_n, gi, gj, gx, gy, gw, gh, gim, gre, anchors_wh, ious, ignore_thresh,
+                     obj_mask, noobj_mask, tbox):
+    """ Fill the (already reset) target arrays of build_targets in one loop over the target boxes
+
+    :param b, best_n, gi, gj: [num_targets] int arrays
+    :param gx, gy, gw, gh, gim, gre: [num_targets] target boxes in grid units
+    :param anchors_wh: [num_anchors, 2+] scaled anchors
+    :param ious: [num_anchors, num_targets]
+    :param ignore_thresh:
+    :param obj_mask, noobj_mask: [nB, nA, nG, nG] bool arrays
+    :param tbox: [nB, nA, nG, nG, 6] (tx, ty, tw, th, tim, tre)
+    :return:
+    """
+    nB, nA, nG, _ = obj_mask.shape
+    for t in range(b.shape[0]):
+        bt, at, jt, it = b[t], best_n[t], gj[t], gi[t]
+        # Negative indices count from the end, as in the PyTorch indexing
+        if bt < 0:
+            bt += nB
+        if jt < 0:
+            jt += nG
+        if it < 0:
+            it += nG
+        if bt < 0 or bt >= nB or jt < 0 or jt >= nG or it < 0 or it >= nG:
+            raise IndexError('target box is out of the grid')
+        # Set masks
+        obj_mask[bt, at, jt, it] = True
+        noobj_mask[bt, at, jt, it] = False
+        # Set noobj mask to zero where iou exceeds ignore threshold
+        for a in range(nA):
+            if ious[a, t] > ignore_thresh:
+                noobj_mask[bt, a, jt, it] = False
+
+        # Coordinates
+        tbox[bt, at, jt, it, 0] = gx[t] - math.floor(gx[t])
+        tbox[bt, at, jt, it, 1] = gy[t] - math.floor(gy[t])
+        # Width and height
+        tbox[bt, at, jt, it, 2] = math.log(gw[t] / anchors_wh[at, 0] + 1e-16)
+        tbox[bt, at, jt, it, 3] = math.log(gh[t] / anchors_wh[at, 1] + 1e-16)
+        # Im and real part
+        tbox[bt, at, jt, it, 4] = gim[t]
+        tbox[bt, at, jt, it, 5] = gre[t]